@@ -1,6 +1,20 @@
-import os, urllib.parse, logging, sys, time, threading, json, re
-from flask import Flask, request
+import os
 from dotenv import load_dotenv
+load_dotenv()
+# Coöperatieve modus: gevent moet sockets/threading patchen vóórdat requests en threading geladen worden.
+# Onder gunicorn -k gevent is dit al gebeurd; CONCURRENCY_MODE=gevent doet het ook bij "python app.py".
+if os.getenv("CONCURRENCY_MODE", "auto").lower() == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+import urllib.parse, logging, sys, time, threading, json, re, hashlib
+try:
+    import resource  # alleen beschikbaar op Unix (productie draait in Docker)
+except ImportError:
+    resource = None
+import heapq, itertools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request
 import requests
 # --------------------------------------------------------------------------
 # LOGGING
@@ -16,7 +30,6 @@ log.info("✅ Logging gestart")
 # --------------------------------------------------------------------------
 # CONFIG
 # --------------------------------------------------------------------------
-load_dotenv()
 required = ["HALO_AUTH_URL", "HALO_API_BASE", "HALO_CLIENT_ID", "HALO_CLIENT_SECRET", "WEBEX_BOT_TOKEN", "AUTHORIZED_USERS"]
 missing = [k for k in required if not os.getenv(k)]
 if missing:
@@ -31,6 +44,7 @@ HALO_TICKET_TYPE_ID = int(os.getenv("HALO_TICKET_TYPE_ID", 66))
 HALO_CLIENT_ID_NUM  = int(os.getenv("HALO_CLIENT_ID_NUM", 12))
 HALO_SITE_ID        = int(os.getenv("HALO_SITE_ID", 18))
 WEBEX_TOKEN         = os.getenv("WEBEX_BOT_TOKEN")
+WEBEX_API_BASE      = os.getenv("WEBEX_API_BASE", "https://webexapis.com/v1").rstrip('/')
 AUTHORIZED_USERS = [email.strip() for email in os.getenv("AUTHORIZED_USERS", "").split(",") if email.strip()]
 log.info(f"✅ Geautoriseerde gebruikers voor KB verwijdering: {AUTHORIZED_USERS}")
 WEBEX_HEADERS = {"Authorization": f"Bearer {WEBEX_TOKEN}",
@@ -52,8 +66,10 @@ USER_CACHE = {
 }
 # Mapping van room naar tickets: {room_id: [ticket_id1, ticket_id2, ...]}
 USER_TICKET_MAP = {}
-# Status & assignee tracker: {ticket_id: {status: str, assignee: str|None, last_checked: ts}}
+# Status & assignee tracker: {ticket_id: {status: str, assignee: str|None, last_checked: ts, closed_at: ts (optioneel)}}
 TICKET_STATUS_TRACKER = {}
+# Lifecycle bookkeeping: laatste eviction run en aantal gearchiveerde tickets in dit proces
+TICKET_LIFECYCLE = {"last_evict": 0, "archived": 0}
 # Cache voor duplicate webhook events: {(ticket_id, type, hash): timestamp}
 LAST_WEBHOOK_EVENTS = {}
 CACHE_DURATION = 24 * 60 * 60  # 24 uur
@@ -61,6 +77,52 @@ MAX_PAGES = 3  # Max 3 pagina's (100 + 100 + 100 = 300 users)
 # Nieuwe variabelen voor HALO actie-ID en notitieveld
 ACTION_ID_PUBLIC = int(os.getenv("ACTION_ID_PUBLIC", 145))
 NOTE_FIELD_NAME = os.getenv("NOTE_FIELD_NAME", "Note")
+# Tracing van requests/jobs en uitgaande Halo/Webex calls:
+# - TRACE_SLOW_MS: traces boven deze duur (ms) geven één samenvattende logregel
+# - TRACE_BUFFER_SIZE: aantal traagste traces dat bewaard wordt voor /debug/traces
+# - TRACE_MAX_AGE_SECONDS: traces ouder dan dit vallen uit de buffer (zodat het "recent" blijft)
+# - TRACE_MAX_SPANS: max. aantal spans per trace; overige worden alleen geteld
+TRACE_SLOW_MS = int(os.getenv("TRACE_SLOW_MS", 2000))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", 100))
+TRACE_MAX_AGE_SECONDS = int(os.getenv("TRACE_MAX_AGE_SECONDS", 60 * 60))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", 200))
+# Ticket lifecycle: tickets met een eindstatus worden na een grace periode uit het geheugen
+# gehaald en naar een compact JSONL archief op schijf geschreven.
+# - TERMINAL_STATUSES: komma gescheiden statusnamen die als afgesloten gelden (case-insensitive)
+# - TICKET_EVICT_GRACE_SECONDS: hoe lang een afgesloten ticket nog in het geheugen blijft
+# - MAX_TRACKED_TICKETS / MAX_TICKETS_PER_ROOM: harde limieten; oudste tickets worden gearchiveerd
+TERMINAL_STATUSES = [s.strip().lower() for s in os.getenv("TERMINAL_STATUSES", "closed,resolved,cancelled,gesloten,opgelost,geannuleerd").split(',') if s.strip()]
+TICKET_EVICT_GRACE_SECONDS = int(os.getenv("TICKET_EVICT_GRACE_SECONDS", 24 * 60 * 60))
+TICKET_EVICT_INTERVAL = int(os.getenv("TICKET_EVICT_INTERVAL", 300))
+MAX_TRACKED_TICKETS = int(os.getenv("MAX_TRACKED_TICKETS", 5000))
+MAX_TICKETS_PER_ROOM = int(os.getenv("MAX_TICKETS_PER_ROOM", 100))
+TICKET_ARCHIVE_PATH = os.getenv("TICKET_ARCHIVE_PATH", "ticket_archive.jsonl")
+# Circuit breakers per upstream (halo_auth, halo_api, webex) en uitgestelde schrijfacties:
+# - CIRCUIT_FAILURE_THRESHOLD: aantal opeenvolgende fouten waarna het circuit open gaat
+# - CIRCUIT_RESET_SECONDS: hoe lang het circuit open blijft voordat één probe-call wordt toegelaten
+# - RETRY_QUEUE_PATH / RETRY_QUEUE_MAX: persistente wachtrij voor notes en tickets tijdens een storing
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_SECONDS = int(os.getenv("CIRCUIT_RESET_SECONDS", 30))
+RETRY_QUEUE_PATH = os.getenv("RETRY_QUEUE_PATH", "retry_queue.json")
+RETRY_QUEUE_MAX = int(os.getenv("RETRY_QUEUE_MAX", 500))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 3))
+# Opnemen van inkomende webhooks voor load tests (zie replay.py):
+# - RECORD_WEBHOOKS_PATH: JSONL bestand waar geanonimiseerde /webex en /halo-action payloads aan toegevoegd worden (leeg = uit)
+# - REPLAY_SEED_ENABLED: zet /debug/seed aan, waarmee replay.py de opgenomen ticket → room koppeling laadt (alleen load tests)
+RECORD_WEBHOOKS_PATH = os.getenv("RECORD_WEBHOOKS_PATH", "")
+REPLAY_SEED_ENABLED = os.getenv("REPLAY_SEED_ENABLED", "0") in ["1", "true", "True"]
+# Room ticket overzicht (bulk query op /api/Tickets):
+# - HALO_TICKET_COLUMNS_ID: optioneel Halo kolomprofiel zodat de list query alleen de benodigde kolommen teruggeeft
+# - ROOM_TICKETS_PAGE_SIZE: standaard aantal tickets per pagina voor /tickets/<room_id> en "mijn tickets"
+HALO_TICKET_COLUMNS_ID = os.getenv("HALO_TICKET_COLUMNS_ID", "")
+ROOM_TICKETS_PAGE_SIZE = int(os.getenv("ROOM_TICKETS_PAGE_SIZE", 20))
+# Concurrency model (zie sectie CONCURRENCY):
+# - CONCURRENCY_MODE: "gevent" (greenlets), "threads" (OS threads) of "auto" (gevent als sockets gepatcht zijn)
+# - WORKER_POOL_SIZE: max. aantal gelijktijdige webhook jobs; bij een vol pool wacht de webhook tot er plek is
+# - KB_DELETE_CONCURRENCY: aantal parallelle DELETE calls bij het leegmaken van de Knowledge Base
+CONCURRENCY_MODE = os.getenv("CONCURRENCY_MODE", "auto").lower()
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", 1000))
+KB_DELETE_CONCURRENCY = int(os.getenv("KB_DELETE_CONCURRENCY", 5))
 # --------------------------------------------------------------------------
 # Controleer of WEBEX_TOKEN is ingesteld
 # --------------------------------------------------------------------------
@@ -70,6 +132,278 @@ if not WEBEX_TOKEN:
 else:
     log.info("✅ Webex bot token is ingesteld")
 # --------------------------------------------------------------------------
+# CONCURRENCY (greenlets of threads, één abstractie voor alle achtergrondwerk)
+# --------------------------------------------------------------------------
+def _detect_concurrency_mode():
+    if CONCURRENCY_MODE in ["gevent", "threads"]:
+        return CONCURRENCY_MODE
+    try:
+        from gevent import monkey
+    except ImportError:
+        return "threads"
+    return "gevent" if monkey.is_module_patched("socket") else "threads"
+CONCURRENCY = _detect_concurrency_mode()
+if CONCURRENCY == "gevent":
+    import gevent, gevent.pool
+    WORKER_POOL = gevent.pool.Pool(WORKER_POOL_SIZE)
+else:
+    WORKER_POOL = threading.BoundedSemaphore(WORKER_POOL_SIZE)
+log.info(f"✅ Concurrency mode: {CONCURRENCY} (worker pool {WORKER_POOL_SIZE})")
+def spawn_worker(fn, *args):
+    # Kortlopende job (webhook verwerking) binnen de begrensde worker pool
+    if CONCURRENCY == "gevent":
+        return WORKER_POOL.spawn(fn, *args)
+    WORKER_POOL.acquire()
+    def run():
+        try:
+            fn(*args)
+        finally:
+            WORKER_POOL.release()
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    return t
+def spawn_background(fn, *args):
+    # Langlopende job (poller, retry replay) buiten de worker pool
+    if CONCURRENCY == "gevent":
+        return gevent.spawn(fn, *args)
+    t = threading.Thread(target=fn, args=args, daemon=True)
+    t.start()
+    return t
+def cooperative_sleep(seconds):
+    if CONCURRENCY == "gevent":
+        gevent.sleep(seconds)
+    else:
+        time.sleep(seconds)
+def run_parallel(fn, items, size):
+    # Voert fn uit over items met maximaal size tegelijk; resultaten in dezelfde volgorde als items
+    # Workers schrijven hun spans in de trace van de aanroeper
+    fn = bind_trace(fn)
+    if CONCURRENCY == "gevent":
+        return list(gevent.pool.Pool(size).imap(fn, items))
+    with ThreadPoolExecutor(max_workers=size) as pool:
+        return list(pool.map(fn, items))
+# --------------------------------------------------------------------------
+# TRACING (per request / background job)
+# --------------------------------------------------------------------------
+# Top-N van traagste recente traces als min-heap: [(duration_ms, volgnummer, trace)].
+# De snelste staat bovenaan en wordt verdrongen door een tragere; snelle /health calls duwen
+# trage traces er dus niet uit. trace = {name, start, duration_ms, tags, spans: [...], spans_dropped}
+TRACE_BUFFER = []
+TRACE_SEQ = itertools.count()
+TRACE_LOCK = threading.Lock()
+def _prune_trace_buffer(now):
+    # Aanroepen met TRACE_LOCK; verwijdert traces buiten het tijdvenster
+    cutoff = now - TRACE_MAX_AGE_SECONDS
+    if any(item[2]["start"] < cutoff for item in TRACE_BUFFER):
+        TRACE_BUFFER[:] = [item for item in TRACE_BUFFER if item[2]["start"] >= cutoff]
+        heapq.heapify(TRACE_BUFFER)
+# Trace en span-diepte per thread/greenlet; bind_trace geeft ze door aan workers (zie run_parallel)
+_trace_local = threading.local()
+def start_trace(name, **tags):
+    trace = {"name": name, "start": time.time(), "t0": time.perf_counter(),
+             "tags": tags, "spans": [], "spans_dropped": 0}
+    _trace_local.trace = trace
+    _trace_local.depth = 0
+    return trace
+def bind_trace(fn):
+    # Koppelt fn aan de lopende trace, zodat spans uit een andere thread/greenlet niet verloren gaan
+    trace = getattr(_trace_local, "trace", None)
+    depth = getattr(_trace_local, "depth", 0)
+    if trace is None:
+        return fn
+    def wrapper(*args, **kwargs):
+        prev = (getattr(_trace_local, "trace", None), getattr(_trace_local, "depth", 0))
+        _trace_local.trace, _trace_local.depth = trace, depth
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _trace_local.trace, _trace_local.depth = prev
+    return wrapper
+def finish_trace(error=None):
+    trace = getattr(_trace_local, "trace", None)
+    if trace is None:
+        return None
+    _trace_local.trace = None
+    trace["duration_ms"] = round((time.perf_counter() - trace.pop("t0")) * 1000, 1)
+    if error:
+        trace["error"] = str(error)
+    item = (trace["duration_ms"], next(TRACE_SEQ), trace)
+    with TRACE_LOCK:
+        _prune_trace_buffer(time.time())
+        if len(TRACE_BUFFER) < TRACE_BUFFER_SIZE:
+            heapq.heappush(TRACE_BUFFER, item)
+        elif TRACE_BUFFER and item[0] > TRACE_BUFFER[0][0]:
+            heapq.heapreplace(TRACE_BUFFER, item)
+    if trace["duration_ms"] >= TRACE_SLOW_MS:
+        dropped = f" (+{trace['spans_dropped']} spans niet bewaard)" if trace["spans_dropped"] else ""
+        log.warning(f"🐢 Trage trace {trace['name']}: {trace['duration_ms']}ms | {summarize_spans(trace['spans'])}{dropped}")
+    return trace
+def summarize_spans(spans):
+    # Tel per span-naam de totale tijd en het aantal calls (alleen top-level spans tellen mee)
+    totals = {}
+    for sp in spans:
+        if sp["depth"] != 0:
+            continue
+        total, count = totals.get(sp["name"], (0.0, 0))
+        totals[sp["name"]] = (total + sp["duration_ms"], count + 1)
+    parts = [f"{n}={round(t, 1)}ms" + (f"(x{c})" if c > 1 else "")
+             for n, (t, c) in sorted(totals.items(), key=lambda kv: -kv[1][0])]
+    return ", ".join(parts) or "geen spans"
+@contextmanager
+def traced(name, **tags):
+    """Root trace voor een background job; valt terug op een span als er al een trace loopt."""
+    if getattr(_trace_local, "trace", None) is not None:
+        with span(name, **tags) as sp:
+            yield sp
+        return
+    trace = start_trace(name, **tags)
+    try:
+        yield trace
+    except Exception as e:
+        finish_trace(error=e)
+        raise
+    finish_trace()
+@contextmanager
+def span(name, **tags):
+    """Meet een stuk werk binnen de lopende trace. Zonder actieve trace is dit een no-op."""
+    trace = getattr(_trace_local, "trace", None)
+    sp = {"name": name, "tags": tags}
+    if trace is None:
+        yield sp
+        return
+    t0 = time.perf_counter()
+    sp["offset_ms"] = round((t0 - trace["t0"]) * 1000, 1)
+    sp["depth"] = getattr(_trace_local, "depth", 0)
+    _trace_local.depth = sp["depth"] + 1
+    try:
+        yield sp
+    except Exception as e:
+        sp["error"] = str(e)
+        raise
+    finally:
+        _trace_local.depth = sp["depth"]
+        sp["duration_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        # Lock: spans kunnen via bind_trace uit meerdere workers tegelijk komen
+        with TRACE_LOCK:
+            if len(trace["spans"]) < TRACE_MAX_SPANS:
+                trace["spans"].append(sp)
+            else:
+                trace["spans_dropped"] += 1
+@app.before_request
+def _trace_request_start():
+    if request.endpoint in ["debug_traces", "debug_commands", "debug_seed"]:
+        return
+    start_trace(f"{request.method} {request.path}")
+@app.teardown_request
+def _trace_request_end(exc):
+    finish_trace(error=exc)
+# --------------------------------------------------------------------------
+# WEBHOOK RECORDER (opt-in, voor replay.py)
+# --------------------------------------------------------------------------
+RECORD_LOCK = threading.Lock()
+# Allowlist van velden die onveranderd opgenomen worden (ID's, statussen, structuur voor een realistische replay).
+# Keys worden genormaliseerd (lowercase, zonder "_" en "-"), zodat bv. ticket_id, TicketId en Ticket_ID allemaal matchen.
+RECORD_KEEP_FIELDS = {"id", "resource", "event", "roomid", "roomtype", "personid", "messageid", "parentid",
+                      "created", "orgid", "appid", "actorid",
+                      "ticketid", "ticketnumber",
+                      "status", "statusid", "statusname", "ticketstatus", "currentstatus", "newstatus",
+                      "newstatusname", "statusvalue", "statustext",
+                      "actionid", "action", "actiontype", "actiontypeid", "impact", "urgency"}
+def _record_key(key):
+    return str(key).lower().replace("_", "").replace("-", "")
+def sanitize_payload(obj, keep=False):
+    # Alleen velden uit RECORD_KEEP_FIELDS blijven staan. Overige tekst wordt vervangen door de lengte;
+    # e-mailadressen worden consistent gehasht (zodat dezelfde afzender dezelfde blijft).
+    if isinstance(obj, dict):
+        return {k: sanitize_payload(v, _record_key(k) in RECORD_KEEP_FIELDS) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [sanitize_payload(v, keep) for v in obj]
+    if isinstance(obj, str) and not keep:
+        if "@" in obj and " " not in obj:
+            local, _, domain = obj.partition("@")
+            return f"{hashlib.sha1(local.encode()).hexdigest()[:10]}@{domain}"
+        return f"<redacted:{len(obj)}>"
+    return obj
+def record_webhook(path, payload, content_type="json", rooms=None):
+    # rooms: {ticket_id: room_id} op het moment van opnemen, zodat replay.py de koppeling kan seeden
+    if not RECORD_WEBHOOKS_PATH:
+        return
+    entry = {"ts": round(time.time(), 3), "path": path, "ct": content_type, "body": sanitize_payload(payload)}
+    if rooms:
+        entry["rooms"] = rooms
+    try:
+        with RECORD_LOCK, open(RECORD_WEBHOOKS_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, separators=(",", ":"), ensure_ascii=False) + "\n")
+    except OSError as e:
+        log.error(f"❌ Opnemen webhook naar {RECORD_WEBHOOKS_PATH} mislukt: {e}")
+# --------------------------------------------------------------------------
+# CIRCUIT BREAKERS (per upstream)
+# --------------------------------------------------------------------------
+class CircuitOpenError(Exception):
+    """Upstream is (tijdelijk) onbereikbaar; de call is niet uitgevoerd."""
+    def __init__(self, upstream):
+        super().__init__(f"Circuit voor {upstream} is open")
+        self.upstream = upstream
+# Staat per upstream: closed (normaal), open (fail fast), half_open (één probe onderweg)
+CIRCUITS = {name: {"state": "closed", "failures": 0, "opened_at": 0, "probing": False}
+            for name in ["halo_auth", "halo_api", "webex"]}
+CIRCUIT_LOCK = threading.Lock()
+def circuit_allow(name):
+    c = CIRCUITS[name]
+    with CIRCUIT_LOCK:
+        if c["state"] == "closed":
+            return True
+        if c["state"] == "open" and time.time() - c["opened_at"] >= CIRCUIT_RESET_SECONDS:
+            c["state"] = "half_open"
+            c["probing"] = False
+        if c["state"] == "half_open" and not c["probing"]:
+            c["probing"] = True
+            log.info(f"🔌 Circuit {name} half-open: probe call toegestaan")
+            return True
+        return False
+def circuit_success(name):
+    c = CIRCUITS[name]
+    with CIRCUIT_LOCK:
+        recovered = c["state"] != "closed"
+        c.update(state="closed", failures=0, probing=False)
+    if recovered:
+        log.info(f"✅ Circuit {name} gesloten, upstream weer bereikbaar")
+        if name.startswith("halo"):
+            maybe_replay_retry_queue()
+def circuit_failure(name):
+    c = CIRCUITS[name]
+    with CIRCUIT_LOCK:
+        c["failures"] += 1
+        if c["state"] == "half_open" or c["failures"] >= CIRCUIT_FAILURE_THRESHOLD:
+            if c["state"] != "open":
+                log.error(f"🔌 Circuit {name} open na {c['failures']} fouten; fail fast voor {CIRCUIT_RESET_SECONDS}s")
+            c.update(state="open", opened_at=time.time(), probing=False)
+def circuit_call(name, fn):
+    # Voert fn() uit onder bewaking van het circuit; exceptions en 5xx tellen als fout
+    if not circuit_allow(name):
+        raise CircuitOpenError(name)
+    try:
+        r = fn()
+    except Exception:
+        circuit_failure(name)
+        raise
+    if r.status_code >= 500:
+        circuit_failure(name)
+    else:
+        circuit_success(name)
+    return r
+def is_transient_error(e):
+    # Alleen storingen parkeren/herhalen: circuit open, netwerkfout, timeout of 5xx. Een 4xx (bv. foute credentials) niet.
+    if isinstance(e, (CircuitOpenError, requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(e, "response", None)
+    return isinstance(e, requests.HTTPError) and response is not None and response.status_code >= 500
+def halo_circuits_closed():
+    return all(CIRCUITS[name]["state"] == "closed" for name in ["halo_auth", "halo_api"])
+@app.errorhandler(CircuitOpenError)
+def _circuit_open(e):
+    return {"error": "upstream_unavailable", "upstream": e.upstream}, 503
+# --------------------------------------------------------------------------
 # HALO AUTH
 # --------------------------------------------------------------------------
 def get_halo_headers():
@@ -80,10 +414,12 @@ def get_halo_headers():
         "scope": "all"
     }
     log.info("➡️ Verbinding maken met HALO auth endpoint")
-    r = requests.post(HALO_AUTH_URL,
-                      headers={"Content-Type": "application/x-www-form-urlencoded"},
-                      data=urllib.parse.urlencode(payload),
-                      timeout=10)
+    with span("halo.auth") as sp:
+        r = circuit_call("halo_auth", lambda: requests.post(HALO_AUTH_URL,
+                          headers={"Content-Type": "application/x-www-form-urlencoded"},
+                          data=urllib.parse.urlencode(payload),
+                          timeout=10))
+        sp["tags"]["status"] = r.status_code
     r.raise_for_status()
     token_info = r.json()
     log.info(f"✅ HALO auth succesvol: token expires in {token_info.get('expires_in', 'onbekend')} seconden")
@@ -93,22 +429,29 @@ def get_halo_headers():
 # HELPER FUNCTIE VOOR HALO REQUESTS MET RATE LIMIT HANDLING
 # --------------------------------------------------------------------------
 def halo_request(url, method='GET', headers=None, params=None, json=None, max_retries=3):
+    path = urllib.parse.urlparse(url).path
     for attempt in range(max_retries):
         try:
-            if method == 'GET':
-                r = requests.get(url, headers=headers, params=params, json=json, timeout=15)
-            elif method == 'POST':
-                r = requests.post(url, headers=headers, params=params, json=json, timeout=15)
-            elif method == 'DELETE':
-                r = requests.delete(url, headers=headers, params=params, json=json, timeout=15)
-            else:
-                raise ValueError(f"Onbekende methode: {method}")
+            with span("halo.request", method=method, path=path, attempt=attempt + 1) as sp:
+                if method == 'GET':
+                    send = requests.get
+                elif method == 'POST':
+                    send = requests.post
+                elif method == 'DELETE':
+                    send = requests.delete
+                else:
+                    raise ValueError(f"Onbekende methode: {method}")
+                r = circuit_call("halo_api", lambda: send(url, headers=headers, params=params, json=json, timeout=15))
+                sp["tags"]["status"] = r.status_code
+        except CircuitOpenError:
+            raise
         except Exception as e:
             log.error(f"Request mislukt: {e}")
             if attempt < max_retries - 1:
                 wait_time = 1 * (attempt + 1)
                 log.warning(f"Retrying in {wait_time} seconden (poging {attempt+1}/{max_retries})")
-                time.sleep(wait_time)
+                with span("halo.retry_sleep", seconds=wait_time):
+                    cooperative_sleep(wait_time)
                 continue
             else:
                 raise e
@@ -117,7 +460,8 @@ def halo_request(url, method='GET', headers=None, params=None, json=None, max_re
             retry_after = r.headers.get('Retry-After')
             wait_time = int(retry_after) if retry_after else 10
             log.warning(f"Rate limit bereikt, wachten {wait_time} seconden")
-            time.sleep(wait_time)
+            with span("halo.ratelimit_sleep", seconds=wait_time):
+                cooperative_sleep(wait_time)
             continue
         # Andere status codes
         return r
@@ -125,6 +469,8 @@ def halo_request(url, method='GET', headers=None, params=None, json=None, max_re
 # --------------------------------------------------------------------------
 # STATUS NAAM CONVERSIE (ID → NAAM)
 # --------------------------------------------------------------------------
+# Cache voor status ID → naam; statussen wijzigen zelden en batches vragen vaak dezelfde ID's op
+STATUS_NAME_CACHE = {}
 def get_status_name(status_id):
     try:
         # Alleen converteren als status_id een nummer is
@@ -132,6 +478,8 @@ def get_status_name(status_id):
             status_id = int(status_id)
         if not isinstance(status_id, int):
             return str(status_id)
+        if status_id in STATUS_NAME_CACHE:
+            return STATUS_NAME_CACHE[status_id]
         h = get_halo_headers()
         url = f"{HALO_API_BASE}/api/Status/{status_id}"
         r = halo_request(url, headers=h)
@@ -140,6 +488,7 @@ def get_status_name(status_id):
             # Check meerdere mogelijke veldnamen voor statusnaam
             name = status_data.get("name") or status_data.get("StatusName") or status_data.get("status_name") or status_data.get("Status")
             if name:
+                STATUS_NAME_CACHE[status_id] = name
                 return name
         return str(status_id)
     except Exception as e:
@@ -225,66 +574,212 @@ def send_message(room_id, text):
         return
     try:
         log.info(f"➡️ Sturen Webex bericht naar room {room_id}: '{text[:50]}...'")
-        response = requests.post("https://webexapis.com/v1/messages",
-                      headers=WEBEX_HEADERS,
-                      json={"roomId": room_id, "markdown": text}, timeout=10)
+        with span("webex.send_message") as sp:
+            response = circuit_call("webex", lambda: requests.post(f"{WEBEX_API_BASE}/messages",
+                          headers=WEBEX_HEADERS,
+                          json={"roomId": room_id, "markdown": text}, timeout=10))
+            sp["tags"]["status"] = response.status_code
         log.info(f"✅ Webex bericht verstuurd naar room {room_id} (status: {response.status_code})")
         return response
     except Exception as e:
         log.error(f"❌ Webex send: {e}")
         return None
+# Adaptive card bericht (zonder roomId) wordt eenmalig opgebouwd en geserialiseerd;
+# per verzending wordt alleen het roomId ervoor geplakt.
+ADAPTIVE_CARD_MESSAGE = {
+    "text": "✍ Vul dit formulier in:",
+    "attachments": [{
+        "contentType": "application/vnd.microsoft.card.adaptive",
+        "content": {
+            "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
+            "type": "AdaptiveCard",
+            "version": "1.0",
+            "body": [
+                {"type": "TextBlock", "text": "🆕 Nieuwe melding", "weight": "bolder"},
+                {"type": "Input.Text", "id": "email", "placeholder": "E-mailadres van gebruiker", "required": True},
+                {"type": "Input.Text", "id": "omschrijving", "placeholder": "Korte omschrijving", "required": True},
+                {"type": "Input.Text", "id": "sindswanneer", "placeholder": "Sinds wanneer?"},
+                {"type": "Input.Text", "id": "watwerktniet", "placeholder": "Wat werkt niet?"},
+                {"type": "Input.Text", "id": "zelfgeprobeerd", "placeholder": "Wat heb je al geprobeerd?"},
+                {"type": "Input.Text", "id": "impacttoelichting", "placeholder": "Impact toelichting (optioneel)"},
+                {"type": "Input.ChoiceSet", "id": "impact", "label": "Impact",
+                 "choices": [
+                     {"title": "Gehele bedrijf (1)", "value": "1"},
+                     {"title": "Meerdere gebruikers (2)", "value": "2"},
+                     {"title": "Één gebruiker (3)", "value": "3"}],
+                 "value": "3", "required": True},
+                {"type": "Input.ChoiceSet", "id": "urgency", "label": "Urgency",
+                 "choices": [
+                     {"title": "High (1)", "value": "1"},
+                     {"title": "Medium (2)", "value": "2"},
+                     {"title": "Low (3)", "value": "3"}],
+                 "value": "3", "required": True}
+            ],
+            "actions": [{"type": "Action.Submit", "title": "✅ Ticket aanmaken"}]
+        }
+    }]
+}
+ADAPTIVE_CARD_JSON_TAIL = json.dumps(ADAPTIVE_CARD_MESSAGE, ensure_ascii=False)[1:]
 def send_adaptive_card(room_id):
     if not WEBEX_HEADERS:
         log.error("❌ WEBEX_HEADERS is niet ingesteld")
         return
     log.info(f"➡️ Sturen adaptive card naar room {room_id}")
-    payload = {
-        "roomId": room_id,
-        "text": "✍ Vul dit formulier in:",
-        "attachments": [{
-            "contentType": "application/vnd.microsoft.card.adaptive",
-            "content": {
-                "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-                "type": "AdaptiveCard",
-                "version": "1.0",
-                "body": [
-                    {"type": "TextBlock", "text": "🆕 Nieuwe melding", "weight": "bolder"},
-                    {"type": "Input.Text", "id": "email", "placeholder": "E-mailadres van gebruiker", "required": True},
-                    {"type": "Input.Text", "id": "omschrijving", "placeholder": "Korte omschrijving", "required": True},
-                    {"type": "Input.Text", "id": "sindswanneer", "placeholder": "Sinds wanneer?"},
-                    {"type": "Input.Text", "id": "watwerktniet", "placeholder": "Wat werkt niet?"},
-                    {"type": "Input.Text", "id": "zelfgeprobeerd", "placeholder": "Wat heb je al geprobeerd?"},
-                    {"type": "Input.Text", "id": "impacttoelichting", "placeholder": "Impact toelichting (optioneel)"},
-                    {"type": "Input.ChoiceSet", "id": "impact", "label": "Impact",
-                     "choices": [
-                         {"title": "Gehele bedrijf (1)", "value": "1"},
-                         {"title": "Meerdere gebruikers (2)", "value": "2"},
-                         {"title": "Één gebruiker (3)", "value": "3"}],
-                     "value": "3", "required": True},
-                    {"type": "Input.ChoiceSet", "id": "urgency", "label": "Urgency",
-                     "choices": [
-                         {"title": "High (1)", "value": "1"},
-                         {"title": "Medium (2)", "value": "2"},
-                         {"title": "Low (3)", "value": "3"}],
-                     "value": "3", "required": True}
-                ],
-                "actions": [{"type": "Action.Submit", "title": "✅ Ticket aanmaken"}]
-            }
-        }]
-    }
+    body = ('{"roomId":' + json.dumps(room_id) + ',' + ADAPTIVE_CARD_JSON_TAIL).encode("utf-8")
     try:
-        requests.post("https://webexapis.com/v1/messages",
-                      headers=WEBEX_HEADERS, json=payload, timeout=10)
+        with span("webex.send_card"):
+            circuit_call("webex", lambda: requests.post(f"{WEBEX_API_BASE}/messages",
+                          headers=WEBEX_HEADERS, data=body, timeout=10))
         log.info(f"✅ Adaptive card verstuurd naar room {room_id}")
     except Exception as e:
         log.error(f"❌ Adaptive card versturen mislukt: {e}")
 # --------------------------------------------------------------------------
+# TICKET LIFECYCLE (EVICTION & ARCHIEF)
+# --------------------------------------------------------------------------
+TICKET_EVICT_LOCK = threading.Lock()
+def is_terminal_status(status):
+    return bool(status) and str(status).strip().lower() in TERMINAL_STATUSES
+def set_ticket_status(ticket_id, status):
+    # Centrale plek om status te zetten, zodat closed_at altijd klopt (ook bij heropenen)
+    info = TICKET_STATUS_TRACKER.get(ticket_id)
+    if info is None:
+        return
+    info["status"] = status
+    if is_terminal_status(status):
+        if not info.get("closed_at"):
+            info["closed_at"] = time.time()
+    else:
+        info.pop("closed_at", None)
+def archive_tickets(entries):
+    # Compact formaat: één regel per ticket, korte keys, geen spaties
+    if not entries:
+        return
+    try:
+        with open(TICKET_ARCHIVE_PATH, "a", encoding="utf-8") as f:
+            for e in entries:
+                f.write(json.dumps(e, separators=(",", ":"), ensure_ascii=False) + "\n")
+    except OSError as e:
+        log.error(f"❌ Schrijven naar ticket archief {TICKET_ARCHIVE_PATH} mislukt: {e}")
+def find_archived_ticket(ticket_id, room_id=None):
+    # Lineaire scan van het archief; alleen voor de zeldzame "ticket niet gevonden" paden
+    found = None
+    try:
+        with open(TICKET_ARCHIVE_PATH, encoding="utf-8") as f:
+            for line in f:
+                if f'"t":"{ticket_id}"' not in line:
+                    continue
+                entry = json.loads(line)
+                if entry.get("t") == ticket_id and (room_id is None or entry.get("r") == room_id):
+                    found = entry
+    except (OSError, ValueError) as e:
+        if not isinstance(e, FileNotFoundError):
+            log.error(f"❌ Lezen van ticket archief {TICKET_ARCHIVE_PATH} mislukt: {e}")
+    return found
+def evict_ticket(ticket_id, room_id, reason):
+    info = TICKET_STATUS_TRACKER.pop(ticket_id, None) or {}
+    if reason != "closed" and not info.get("closed_at"):
+        log.warning(f"⚠️ Open ticket {ticket_id} uit room {room_id} gearchiveerd door limiet ({reason})")
+    tickets = USER_TICKET_MAP.get(room_id)
+    if tickets is not None:
+        try:
+            tickets.remove(ticket_id)
+        except ValueError:
+            pass
+        if not tickets:
+            USER_TICKET_MAP.pop(room_id, None)
+    return {"t": ticket_id, "r": room_id, "s": info.get("status"), "a": info.get("assignee"),
+            "c": info.get("closed_at"), "e": int(time.time()), "why": reason}
+def evict_tickets():
+    now = time.time()
+    evicted = []
+    # Room index opbouwen (ticket -> room) zodat we niet per ticket alle rooms doorlopen
+    ticket_room = {}
+    for rid, tickets in list(USER_TICKET_MAP.items()):
+        for tid in tickets:
+            ticket_room[tid] = rid
+    # 1. Afgesloten tickets na de grace periode
+    for tid, info in list(TICKET_STATUS_TRACKER.items()):
+        closed_at = info.get("closed_at")
+        if closed_at and now - closed_at >= TICKET_EVICT_GRACE_SECONDS:
+            evicted.append(evict_ticket(tid, ticket_room.get(tid), "closed"))
+    # 2. Limiet per room: oudste tickets eerst (afgesloten tickets voorrang)
+    for rid, tickets in list(USER_TICKET_MAP.items()):
+        overflow = len(tickets) - MAX_TICKETS_PER_ROOM
+        if overflow <= 0:
+            continue
+        ordered = sorted(tickets, key=lambda t: not TICKET_STATUS_TRACKER.get(t, {}).get("closed_at"))
+        for tid in ordered[:overflow]:
+            evicted.append(evict_ticket(tid, rid, "room_cap"))
+    # 3. Globale limiet op de tracker: afgesloten eerst, daarna minst recent gecontroleerd
+    overflow = len(TICKET_STATUS_TRACKER) - MAX_TRACKED_TICKETS
+    if overflow > 0:
+        ordered = sorted(list(TICKET_STATUS_TRACKER.items()),
+                         key=lambda kv: (not kv[1].get("closed_at"), kv[1].get("last_checked", 0)))
+        for tid, _ in ordered[:overflow]:
+            evicted.append(evict_ticket(tid, ticket_room.get(tid), "global_cap"))
+    archive_tickets(evicted)
+    TICKET_LIFECYCLE["archived"] += len(evicted)
+    TICKET_LIFECYCLE["last_evict"] = now
+    if evicted:
+        log.info(f"🗄️ {len(evicted)} tickets gearchiveerd naar {TICKET_ARCHIVE_PATH} | {json.dumps(memory_footprint())}")
+    return len(evicted)
+def maybe_evict_tickets(force=False):
+    # Goedkoop genoeg om vanuit elke webhook aan te roepen; draait hooguit eens per interval
+    if not force and time.time() - TICKET_LIFECYCLE["last_evict"] < TICKET_EVICT_INTERVAL:
+        return 0
+    if not TICKET_EVICT_LOCK.acquire(blocking=False):
+        return 0
+    try:
+        with span("tickets.evict"):
+            return evict_tickets()
+    except Exception as e:
+        log.error(f"💥 Fout bij ticket eviction: {e}")
+        return 0
+    finally:
+        TICKET_EVICT_LOCK.release()
+def approx_size(obj):
+    # Ruwe schatting van het geheugengebruik van geneste dicts/lists (bytes)
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in list(obj.items()))
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(approx_size(v) for v in list(obj))
+    return size
+def memory_footprint():
+    footprint = {
+        "tickets_tracked": len(TICKET_STATUS_TRACKER),
+        "tickets_closed": sum(1 for i in list(TICKET_STATUS_TRACKER.values()) if i.get("closed_at")),
+        "rooms": len(USER_TICKET_MAP),
+        "room_ticket_refs": sum(len(t) for t in list(USER_TICKET_MAP.values())),
+        "dedupe_entries": len(LAST_WEBHOOK_EVENTS),
+        "tickets_archived": TICKET_LIFECYCLE["archived"],
+        "approx_bytes": approx_size(TICKET_STATUS_TRACKER) + approx_size(USER_TICKET_MAP) + approx_size(LAST_WEBHOOK_EVENTS),
+        "max_tracked_tickets": MAX_TRACKED_TICKETS,
+        "max_tickets_per_room": MAX_TICKETS_PER_ROOM
+    }
+    if resource:
+        footprint["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return footprint
+# --------------------------------------------------------------------------
 # HALO TICKETS
 # --------------------------------------------------------------------------
 def create_halo_ticket(form, room_id):
     if not WEBEX_HEADERS:
         log.error("❌ WEBEX_HEADERS is niet ingesteld")
         return
+    try:
+        return _create_halo_ticket(form, room_id)
+    except (CircuitOpenError, requests.RequestException) as e:
+        if not is_transient_error(e):
+            status = getattr(getattr(e, "response", None), "status_code", "onbekend")
+            send_message(room_id, f"⚠️ Ticket aanmaken mislukt: {status}")
+            log.error(f"❌ Halo ticket aanmaken mislukt: {e}")
+            return
+        # Halo onbereikbaar (circuit open, netwerkfout of 5xx): formulier parkeren en later opnieuw aanmaken
+        log.warning(f"⏸️ Ticket aanmaken uitgesteld ({e})")
+        enqueue_retry("create_ticket", form=form, room_id=room_id)
+        send_message(room_id, "⏳ Halo is momenteel niet bereikbaar. Je melding is opgeslagen en het ticket wordt automatisch aangemaakt zodra Halo weer beschikbaar is.")
+def _create_halo_ticket(form, room_id):
     h = get_halo_headers()
     user = get_user(form["email"])
     if not user:
@@ -313,6 +808,8 @@ def create_halo_ticket(form, room_id):
     url = f"{HALO_API_BASE}/api/Tickets"
     log.info(f"➡️ Creëer Halo ticket met body: {json.dumps(body, indent=2)}")
     r = halo_request(url, method='POST', headers=h, json=[body])
+    if r.status_code >= 500:
+        r.raise_for_status()  # tijdelijke storing: create_halo_ticket parkeert het formulier
     if not r.ok:
         send_message(room_id, f"⚠️ Ticket aanmaken mislukt: {r.status_code}")
         log.error(f"❌ Halo ticket aanmaken mislukt: {r.status_code} - {r.text}")
@@ -334,21 +831,35 @@ def create_halo_ticket(form, room_id):
         log.error("❌ Geen ticket ID gevonden in Halo response")
         return
     log.info(f"✅ Ticket aangemaakt: {tid}")
-    if room_id not in USER_TICKET_MAP:
-        USER_TICKET_MAP[room_id] = []
-    USER_TICKET_MAP[room_id].append(tid)
+    room_tickets = USER_TICKET_MAP.setdefault(room_id, [])
+    room_tickets.append(tid)
     # Init tracker zonder assignee
-    TICKET_STATUS_TRACKER[tid] = {"status": current_status, "assignee": None, "last_checked": time.time()}
+    TICKET_STATUS_TRACKER[tid] = {"status": None, "assignee": None, "last_checked": time.time()}
+    set_ticket_status(tid, current_status)
+    maybe_evict_tickets(force=len(room_tickets) > MAX_TICKETS_PER_ROOM)
     send_message(room_id, f"✅ Ticket aangemaakt: **{tid}**")
     log.info(f"✅ Ticket {tid} toegevoegd aan room {room_id}")
     return tid
 # --------------------------------------------------------------------------
 # PUBLIC NOTE FUNCTIE (CORRECTE IMPLEMENTATIE)
 # --------------------------------------------------------------------------
-def add_public_note(ticket_id, text):
+# Retourwaarde van add_public_note als de note geparkeerd is in de retry queue
+NOTE_QUEUED = "queued"
+def add_public_note(ticket_id, text, room_id=None):
     if not WEBEX_HEADERS:
         log.error("❌ WEBEX_HEADERS is niet ingesteld")
         return False
+    try:
+        return _add_public_note(ticket_id, text)
+    except (CircuitOpenError, requests.RequestException) as e:
+        if not is_transient_error(e):
+            log.error(f"❌ Public note mislukt voor ticket {ticket_id}: {e}")
+            return False
+        # Circuit open, netwerkfout of 5xx: note parkeren in plaats van kwijtraken
+        log.warning(f"⏸️ Public note voor ticket {ticket_id} uitgesteld ({e})")
+        enqueue_retry("public_note", ticket_id=ticket_id, text=text, room_id=room_id)
+        return NOTE_QUEUED
+def _add_public_note(ticket_id, text):
     h = get_halo_headers()
     url = f"{HALO_API_BASE}/api/Actions"
     payload = [
@@ -363,14 +874,115 @@ def add_public_note(ticket_id, text):
     if r.status_code in [200, 201]:
         log.info(f"✅ Public note succesvol toegevoegd aan ticket {ticket_id}")
         return True
+    elif r.status_code >= 500:
+        log.error(f"❌ Public note mislukt: {r.status_code} - {r.text}")
+        r.raise_for_status()  # tijdelijke storing: aanroeper parkeert of telt het als mislukte poging
     else:
         log.error(f"❌ Public note mislukt: {r.status_code} - {r.text}")
         return False
 # --------------------------------------------------------------------------
+# RETRY QUEUE (UITGESTELDE SCHRIJFACTIES TIJDENS HALO STORING)
+# --------------------------------------------------------------------------
+# Persistente lijst van jobs: {id, kind: public_note|create_ticket, args: {...}, queued_at, attempts}
+RETRY_QUEUE = []
+RETRY_QUEUE_LOCK = threading.Lock()
+RETRY_REPLAY_LOCK = threading.Lock()
+def _save_retry_queue():
+    # Atomisch wegschrijven zodat een crash halverwege de queue niet corrumpeert
+    tmp = RETRY_QUEUE_PATH + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(RETRY_QUEUE, f, ensure_ascii=False)
+        os.replace(tmp, RETRY_QUEUE_PATH)
+    except OSError as e:
+        log.error(f"❌ Opslaan retry queue naar {RETRY_QUEUE_PATH} mislukt: {e}")
+def load_retry_queue():
+    if not os.path.exists(RETRY_QUEUE_PATH):
+        return
+    try:
+        with open(RETRY_QUEUE_PATH, encoding="utf-8") as f:
+            jobs = json.load(f)
+    except (OSError, ValueError) as e:
+        log.error(f"❌ Inlezen retry queue {RETRY_QUEUE_PATH} mislukt: {e}")
+        return
+    with RETRY_QUEUE_LOCK:
+        RETRY_QUEUE[:] = jobs
+    log.info(f"✅ {len(jobs)} uitgestelde jobs ingelezen uit {RETRY_QUEUE_PATH}")
+def enqueue_retry(kind, **args):
+    job = {"id": f"{time.time():.6f}-{kind}", "kind": kind, "args": args, "queued_at": time.time(), "attempts": 0}
+    with RETRY_QUEUE_LOCK:
+        if len(RETRY_QUEUE) >= RETRY_QUEUE_MAX:
+            dropped = RETRY_QUEUE.pop(0)
+            log.error(f"❌ Retry queue vol ({RETRY_QUEUE_MAX}); oudste job {dropped['kind']} verwijderd")
+        RETRY_QUEUE.append(job)
+        _save_retry_queue()
+    log.info(f"📥 Job {kind} in retry queue geplaatst ({len(RETRY_QUEUE)} wachtend)")
+def _run_retry_job(job):
+    args = job["args"]
+    if job["kind"] == "public_note":
+        ok = _add_public_note(args["ticket_id"], args["text"])
+        if args.get("room_id"):
+            if ok:
+                send_message(args["room_id"], f"📝 Uitgesteld bericht alsnog toegevoegd aan Halo ticket #{args['ticket_id']}.")
+            else:
+                send_message(args["room_id"], f"❌ Uitgesteld bericht kon niet worden toegevoegd aan ticket #{args['ticket_id']}.")
+    elif job["kind"] == "create_ticket":
+        _create_halo_ticket(args["form"], args["room_id"])
+    else:
+        log.warning(f"⚠️ Onbekend job type in retry queue: {job['kind']}")
+def replay_retry_queue():
+    if not RETRY_REPLAY_LOCK.acquire(blocking=False):
+        return
+    try:
+        with traced("job:retry_replay", queued=len(RETRY_QUEUE)):
+            while True:
+                with RETRY_QUEUE_LOCK:
+                    if not RETRY_QUEUE:
+                        break
+                    job = RETRY_QUEUE[0]
+                if not halo_circuits_closed():
+                    log.warning("⏸️ Replay retry queue gestopt: Halo circuit niet dicht")
+                    break
+                try:
+                    _run_retry_job(job)
+                except CircuitOpenError as e:
+                    log.warning(f"⏸️ Replay retry queue gestopt: {e}")
+                    break
+                except Exception as e:
+                    # Storing waardoor een Halo circuit weer openging: Halo is nog niet hersteld,
+                    # dus geen poging tellen en de job bewaren tot het circuit weer dicht is.
+                    if is_transient_error(e) and not halo_circuits_closed():
+                        log.warning(f"⏸️ Replay retry queue gestopt, Halo nog niet hersteld: {e}")
+                        break
+                    job["attempts"] = job.get("attempts", 0) + 1
+                    if job["attempts"] < RETRY_MAX_ATTEMPTS:
+                        log.error(f"💥 Job {job['kind']} uit retry queue mislukt (poging {job['attempts']}/{RETRY_MAX_ATTEMPTS}): {e}")
+                        with RETRY_QUEUE_LOCK:
+                            _save_retry_queue()
+                        break
+                    log.error(f"💥 Job {job['kind']} uit retry queue definitief mislukt, verwijderd: {e}")
+                    if job["args"].get("room_id"):
+                        target = f"ticket #{job['args']['ticket_id']}" if job["kind"] == "public_note" else "je melding"
+                        send_message(job["args"]["room_id"], f"❌ Uitgestelde actie voor {target} kon na {RETRY_MAX_ATTEMPTS} pogingen niet worden verwerkt in Halo.")
+                with RETRY_QUEUE_LOCK:
+                    if RETRY_QUEUE and RETRY_QUEUE[0] is job:
+                        RETRY_QUEUE.pop(0)
+                    _save_retry_queue()
+                log.info(f"✅ Job {job['kind']} uit retry queue verwerkt ({len(RETRY_QUEUE)} wachtend)")
+    finally:
+        RETRY_REPLAY_LOCK.release()
+def maybe_replay_retry_queue():
+    # Start replay op de achtergrond als er werk ligt, er nog geen replay loopt en Halo weer bereikbaar is
+    # (beide Halo circuits dicht). Een half-open probe laten we aan gewone calls over.
+    if RETRY_QUEUE and not RETRY_REPLAY_LOCK.locked() and halo_circuits_closed():
+        spawn_background(replay_retry_queue)
+load_retry_queue()
+# --------------------------------------------------------------------------
 # STATUS WIJZIGINGEN
 # --------------------------------------------------------------------------
 def check_ticket_status_changes():
     h = get_halo_headers()
+    # Afgesloten tickets blijven gepolld tot ze na de grace periode gearchiveerd worden, zodat heropenen gezien wordt
     for ticket_id, status_info in list(TICKET_STATUS_TRACKER.items()):
         try:
             # Haal volledige ticket details met includedetails=true
@@ -407,7 +1019,7 @@ def check_ticket_status_changes():
                     assignee_changed = True
                     TICKET_STATUS_TRACKER[ticket_id]["assignee"] = current_assignee
                     room_id = None
-                    for rid, tickets in USER_TICKET_MAP.items():
+                    for rid, tickets in list(USER_TICKET_MAP.items()):
                         if ticket_id in tickets:
                             room_id = rid
                             break
@@ -417,11 +1029,13 @@ def check_ticket_status_changes():
                 if current_status != status_info["status"]:
                     # Alleen melden als whitelist leeg is uitgeschakeld OF als de nieuwe status in de whitelist zit
                     if STATUS_NOTIFY_WHITELIST and current_status.lower() not in STATUS_NOTIFY_WHITELIST:
+                        # Wel bijwerken (zonder melding), anders wordt dezelfde wijziging elke poll opnieuw gezien
+                        set_ticket_status(ticket_id, current_status)
                         log.info(f"🔕 Status {status_info['status']} → {current_status} genegeerd (niet in whitelist)")
                     else:
-                        TICKET_STATUS_TRACKER[ticket_id]["status"] = current_status
+                        set_ticket_status(ticket_id, current_status)
                         room_id = None
-                        for rid, tickets in USER_TICKET_MAP.items():
+                        for rid, tickets in list(USER_TICKET_MAP.items()):
                             if ticket_id in tickets:
                                 room_id = rid
                                 break
@@ -433,9 +1047,188 @@ def check_ticket_status_changes():
                         log.info(f"✅ Statuswijziging gedetecteerd voor ticket {ticket_id}: {status_info['status']} → {current_status}")
             else:
                 log.warning(f"⚠️ Ticket status check mislukt voor {ticket_id}: {r.status_code}")
+        except CircuitOpenError as e:
+            log.warning(f"⏸️ Statuscheck afgebroken: {e}")
+            break
         except Exception as e:
             log.error(f"💥 Fout bij statuscheck voor ticket {ticket_id}: {e}")
 # --------------------------------------------------------------------------
+# ROOM TICKET OVERZICHT (ÉÉN BULK QUERY)
+# --------------------------------------------------------------------------
+def fetch_tickets_bulk(ticket_ids):
+    # Haalt alle gevraagde tickets op met één gefilterde list query i.p.v. één call per ticket
+    if not ticket_ids:
+        return {}
+    h = get_halo_headers()
+    found = {}
+    page_no = 1
+    while True:
+        params = {
+            "ticketids": ",".join(str(t) for t in ticket_ids),
+            "pageinate": True,
+            "page_size": len(ticket_ids),
+            "page_no": page_no
+        }
+        if HALO_TICKET_COLUMNS_ID:
+            params["columns_id"] = HALO_TICKET_COLUMNS_ID
+        log.info(f"➡️ Bulk ophalen van {len(ticket_ids)} tickets (pagina {page_no})")
+        r = halo_request(f"{HALO_API_BASE}/api/Tickets", headers=h, params=params)
+        if r.status_code != 200:
+            log.warning(f"⚠️ Bulk ticket query gaf {r.status_code}: {r.text[:200]}")
+            break
+        data = r.json()
+        tickets = data if isinstance(data, list) else data.get("tickets", []) or data.get("data", [])
+        for t in tickets:
+            tid = str(t.get("id") or t.get("TicketNumber") or t.get("TicketID") or "")
+            if tid:
+                found[tid] = t
+        record_count = data.get("record_count", len(found)) if isinstance(data, dict) else len(found)
+        if not tickets or len(found) >= min(record_count, len(ticket_ids)):
+            break
+        page_no += 1
+    return found
+def room_ticket_page(room_id, page, page_size):
+    # Tickets van de room, nieuwste eerst
+    all_ids = list(reversed(USER_TICKET_MAP.get(room_id, [])))
+    return all_ids[(page - 1) * page_size:page * page_size], len(all_ids)
+def refresh_room_tickets(room_id, page=1, page_size=ROOM_TICKETS_PAGE_SIZE):
+    # Pagineert over de tickets van de room, ververst die pagina in één query
+    # en werkt de tracker bij zonder notificaties te sturen.
+    page_ids, total = room_ticket_page(room_id, page, page_size)
+    found = fetch_tickets_bulk(page_ids)
+    rows = []
+    for tid in page_ids:
+        t = found.get(tid)
+        info = TICKET_STATUS_TRACKER.get(tid)
+        if t is not None:
+            status = t.get("status_name") or t.get("StatusName") or t.get("Status") or t.get("status_id") or t.get("status")
+            if isinstance(status, int) or (isinstance(status, str) and status.isdigit()):
+                status = get_status_name(status)
+            assignee = t.get("agent_name") or t.get("assigned_to") or t.get("AssignedTo") or t.get("assignee")
+            if info is None:
+                info = TICKET_STATUS_TRACKER[tid] = {"status": None, "assignee": None}
+            # Rij zonder statusveld: bekende status niet wissen
+            if status:
+                set_ticket_status(tid, status)
+            if assignee:
+                info["assignee"] = assignee
+            info["last_checked"] = time.time()
+        info = info or {}
+        rows.append({
+            "ticket_id": tid,
+            "status": info.get("status"),
+            "assignee": info.get("assignee"),
+            "summary": t.get("summary") if t else None,
+            "found": t is not None
+        })
+    return rows, total
+def format_room_tickets(rows, total, page, page_size):
+    if not rows:
+        return "ℹ️ Geen tickets gevonden in deze room. Stuur 'nieuwe melding' om een ticket aan te maken."
+    lines = [f"📋 **Tickets in deze room** ({total} totaal)"]
+    for row in rows:
+        assignee = f" — {row['assignee']}" if row["assignee"] else ""
+        summary = f": {row['summary']}" if row["summary"] else ""
+        lines.append(f"- **#{row['ticket_id']}**{summary} — {row['status'] or 'onbekend'}{assignee}")
+    remaining = total - page * page_size
+    if remaining > 0:
+        lines.append(f"\n… en nog {remaining} oudere tickets")
+    return "\n".join(lines)
+# --------------------------------------------------------------------------
+# COMMAND ROUTER (CHAT COMMANDO'S)
+# --------------------------------------------------------------------------
+def cmd_empty_kb(match, text, room_id, sender):
+    if sender not in AUTHORIZED_USERS:
+        send_message(room_id, "❌ ❌ **Geen toestemming!** Jij bent niet geautoriseerd om Knowledge Base te wissen. Neem contact op met de beheerder.")
+        return
+    send_message(room_id, "⏳ Bezig met verwijderen van alle Knowledge Base artikelen...")
+    try:
+        count = empty_knowledge_base()
+    except CircuitOpenError:
+        send_message(room_id, "⚠️ Halo is momenteel niet bereikbaar. Probeer het later opnieuw.")
+        return
+    send_message(room_id, f"✅ **{count} KB artikelen succesvol verwijderd**")
+def cmd_mijn_tickets(match, text, room_id, sender):
+    log.info("ℹ️ Bericht bevat 'mijn tickets', stuur ticket overzicht")
+    try:
+        rows, total = refresh_room_tickets(room_id)
+    except (CircuitOpenError, requests.RequestException) as e:
+        log.error(f"❌ Tickets verversen voor room {room_id} mislukt: {e}")
+        send_message(room_id, "⚠️ Halo is momenteel niet bereikbaar. Probeer het later opnieuw.")
+        return
+    send_message(room_id, format_room_tickets(rows, total, 1, ROOM_TICKETS_PAGE_SIZE))
+def cmd_nieuwe_melding(match, text, room_id, sender):
+    log.info("ℹ️ Bericht bevat 'nieuwe melding', stuur adaptive card")
+    send_message(room_id, "👋 Hi! Je hebt 'nieuwe melding' gestuurd. Klik op de knop hieronder om een ticket aan te maken:\n\n"
+                         "Je kunt ook een bericht sturen met 'Ticket #<nummer>' om een reactie te geven aan een specifiek ticket.")
+    send_adaptive_card(room_id)
+def cmd_ticket_note(match, text, room_id, sender):
+    requested_tid = match.group(1)
+    log.info(f"ℹ️ Bericht bevat ticket #{requested_tid}")
+    if requested_tid in USER_TICKET_MAP.get(room_id, []):
+        log.info(f"✅ Ticket #{requested_tid} gevonden in room {room_id}")
+        success = add_public_note(requested_tid, text, room_id)
+        if success == NOTE_QUEUED:
+            send_message(room_id, f"⏳ Halo is momenteel niet bereikbaar. Je bericht voor ticket #{requested_tid} is opgeslagen en wordt automatisch toegevoegd zodra Halo weer beschikbaar is.")
+        elif success:
+            send_message(room_id, f"📝 Bericht toegevoegd aan Halo ticket #{requested_tid}.")
+        else:
+            send_message(room_id, f"❌ Kan geen notitie toevoegen aan ticket #{requested_tid}. Probeer het opnieuw.")
+    else:
+        archived = find_archived_ticket(requested_tid, room_id)
+        if archived:
+            log.info(f"🗄️ Ticket #{requested_tid} is gearchiveerd ({archived.get('why')})")
+            send_message(room_id, f"🗄️ Ticket #{requested_tid} is gearchiveerd (laatste status: {archived.get('s') or 'onbekend'}) en wordt niet meer gevolgd in deze room. Stuur 'nieuwe melding' voor een nieuw ticket.")
+            return
+        log.info(f"❌ Ticket #{requested_tid} bestaat niet in deze room")
+        send_message(room_id, f"❌ Ticket #{requested_tid} bestaat niet in deze room of is niet gekoppeld aan deze room.")
+def cmd_note_all(match, text, room_id, sender):
+    log.info("ℹ️ Geen specifiek ticketnummer in bericht, voeg toe aan alle tickets in de room")
+    room_tickets = list(USER_TICKET_MAP.get(room_id, []))
+    if not room_tickets:
+        send_message(room_id, "ℹ️ Geen tickets gevonden in deze room. Stuur 'nieuwe melding' om een ticket aan te maken.")
+        return
+    queued = False
+    for tid in room_tickets:
+        success = add_public_note(tid, text, room_id)
+        if success == NOTE_QUEUED:
+            queued = True
+        elif not success:
+            log.error(f"❌ Notitie toevoegen aan ticket {tid} mislukt")
+    if queued:
+        send_message(room_id, "⏳ Halo is momenteel niet bereikbaar. Je bericht is opgeslagen en wordt automatisch aan je tickets toegevoegd zodra Halo weer beschikbaar is.")
+    else:
+        send_message(room_id, f"📝 Bericht toegevoegd aan alle jouw tickets in deze room.")
+# Commando tabel: eerste match wint, volgorde = prioriteit. Nieuwe commando's hier toevoegen.
+COMMANDS = [
+    ("empty_kb", re.compile(r"/empty_kb|empty kb", re.IGNORECASE), cmd_empty_kb),
+    ("mijn_tickets", re.compile(r"mijn tickets", re.IGNORECASE), cmd_mijn_tickets),
+    ("nieuwe_melding", re.compile(r"nieuwe melding", re.IGNORECASE), cmd_nieuwe_melding),
+    ("ticket_note", re.compile(r"Ticket #(\d+)"), cmd_ticket_note),
+]
+# Per commando: aantal keer uitgevoerd, totale en maximale duur (ms)
+COMMAND_STATS = {}
+COMMAND_STATS_LOCK = threading.Lock()
+def dispatch_command(text, room_id, sender):
+    name, match, handler = "note_all", None, cmd_note_all
+    for cmd_name, pattern, cmd_handler in COMMANDS:
+        m = pattern.search(text)
+        if m:
+            name, match, handler = cmd_name, m, cmd_handler
+            break
+    t0 = time.perf_counter()
+    try:
+        with span(f"command.{name}"):
+            handler(match, text, room_id, sender)
+    finally:
+        elapsed = (time.perf_counter() - t0) * 1000
+        with COMMAND_STATS_LOCK:
+            stats = COMMAND_STATS.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["count"] += 1
+            stats["total_ms"] += elapsed
+            stats["max_ms"] = max(stats["max_ms"], elapsed)
+    return name
+# --------------------------------------------------------------------------
 # WEBEX EVENTS
 # --------------------------------------------------------------------------
 def process_webex_event(payload):
@@ -445,60 +1238,34 @@ def process_webex_event(payload):
     res = payload.get("resource")
     log.info(f"📩 Verwerken Webex event: resource={res}")
     if res == "messages":
-        mid = payload["data"]["id"]
+        data = payload["data"]
+        mid = data["id"]
         log.info(f"📩 Verwerken bericht: id={mid}")
-        msg = requests.get(f"https://webexapis.com/v1/messages/{mid}", headers=WEBEX_HEADERS).json()
+        # Goedkoopste check eerst: berichten van de bot zelf staan al in de webhook data
+        if data.get("personEmail", "").endswith("@webex.bot"):
+            log.info("❌ Bericht is van de bot zelf, negeren")
+            return
+        # Tekst uit de webhook gebruiken als die meegestuurd is; anders één GET
+        if "text" in data:
+            msg = data
+        else:
+            with span("webex.get_message"):
+                msg = circuit_call("webex", lambda: requests.get(f"{WEBEX_API_BASE}/messages/{mid}",
+                                                                 headers=WEBEX_HEADERS, timeout=10)).json()
         text = msg.get("text", "")
-        room_id = msg.get("roomId")
+        room_id = msg.get("roomId") or data.get("roomId")
         sender = msg.get("personEmail", "")
         log.info(f"📩 Bericht ontvangen van {sender} in room {room_id}: '{text}'")
         if sender and sender.endswith("@webex.bot"):
             log.info("❌ Bericht is van de bot zelf, negeren")
             return
-        # NIEUWE CHECK VOOR KB VERWIJDERING
-        if "/empty_kb" in text.lower() or "empty kb" in text.lower():
-            if sender in AUTHORIZED_USERS:
-                send_message(room_id, "⏳ Bezig met verwijderen van alle Knowledge Base artikelen...")
-                count = empty_knowledge_base()
-                send_message(room_id, f"✅ **{count} KB artikelen succesvol verwijderd**")
-            else:
-                send_message(room_id, "❌ ❌ **Geen toestemming!** Jij bent niet geautoriseerd om Knowledge Base te wissen. Neem contact op met de beheerder.")
-            return
-        if "nieuwe melding" in text.lower():
-            log.info("ℹ️ Bericht bevat 'nieuwe melding', stuur adaptive card")
-            send_message(room_id, "👋 Hi! Je hebt 'nieuwe melding' gestuurd. Klik op de knop hieronder om een ticket aan te maken:\n\n"
-                                 "Je kunt ook een bericht sturen met 'Ticket #<nummer>' om een reactie te geven aan een specifiek ticket.")
-            send_adaptive_card(room_id)
-            return
-        ticket_match = re.search(r'Ticket #(\d+)', text)
-        if ticket_match:
-            requested_tid = ticket_match.group(1)
-            log.info(f"ℹ️ Bericht bevat ticket #{requested_tid}")
-            if room_id in USER_TICKET_MAP and requested_tid in USER_TICKET_MAP[room_id]:
-                log.info(f"✅ Ticket #{requested_tid} gevonden in room {room_id}")
-                success = add_public_note(requested_tid, text)
-                if success:
-                    send_message(room_id, f"📝 Bericht toegevoegd aan Halo ticket #{requested_tid}.")
-                else:
-                    send_message(room_id, f"❌ Kan geen notitie toevoegen aan ticket #{requested_tid}. Probeer het opnieuw.")
-            else:
-                log.info(f"❌ Ticket #{requested_tid} bestaat niet in deze room")
-                send_message(room_id, f"❌ Ticket #{requested_tid} bestaat niet in deze room of is niet gekoppeld aan deze room.")
-        else:
-            log.info("ℹ️ Geen specifiek ticketnummer in bericht, voeg toe aan alle tickets in de room")
-            if room_id in USER_TICKET_MAP:
-                for tid in USER_TICKET_MAP[room_id]:
-                    success = add_public_note(tid, text)
-                    if not success:
-                        log.error(f"❌ Notitie toevoegen aan ticket {tid} mislukt")
-                send_message(room_id, f"📝 Bericht toegevoegd aan alle jouw tickets in deze room.")
-            else:
-                send_message(room_id, "ℹ️ Geen tickets gevonden in deze room. Stuur 'nieuwe melding' om een ticket aan te maken.")
+        dispatch_command(text, room_id, sender)
     elif res == "attachmentActions":
         a_id = payload["data"]["id"]
         log.info(f"📩 Verwerken attachmentActions: id={a_id}")
-        inputs = requests.get(f"https://webexapis.com/v1/attachment/actions/{a_id}",
-                              headers=WEBEX_HEADERS).json().get("inputs", {})
+        with span("webex.get_attachment_action"):
+            inputs = circuit_call("webex", lambda: requests.get(f"{WEBEX_API_BASE}/attachment/actions/{a_id}",
+                                                                headers=WEBEX_HEADERS, timeout=10)).json().get("inputs", {})
         room_id = payload["data"]["roomId"]
         log.info(f"📩 attachmentActions in room {room_id} met inputs: {json.dumps(inputs, indent=2)}")
         create_halo_ticket(inputs, room_id)
@@ -514,8 +1281,32 @@ def halo_action():
     if not auth or auth.username != "Webexbot" or auth.password != "Webexbot2025":
         log.error("❌ Ongeldige credentials voor Halo webhook")
         return {"status": "unauthorized"}, 401
-    # --- GEREDUCEERDE LOGGING VAN WEBHOOK DATA ---
     data = request.json if request.is_json else request.form.to_dict()
+    if RECORD_WEBHOOKS_PATH:
+        events = data if isinstance(data, list) else [data]
+        tids = [halo_event_ticket_id(e) for e in events if isinstance(e, dict)]
+        rooms = {tid: room for tid in tids if tid and (room := find_ticket_room(tid))}
+        record_webhook("/halo-action", data, "json" if request.is_json else "form", rooms)
+    # Halo kan ook een array van events sturen (bv. bij bulk updates)
+    if isinstance(data, list):
+        return process_halo_batch(data)
+    result, room_id, message = handle_halo_event(parse_halo_event(data))
+    if message:
+        send_message(room_id, message)
+    return {"status": result}
+def halo_event_ticket_id(data):
+    # Controleer alle mogelijke veldnamen voor ticket ID; string voor consistentie
+    for f in ["ticket_id", "TicketId", "TicketID", "TicketNumber", "id", "Ticket_Id", "ticketnumber", "Ticket_ID", "ticketid"]:
+        if f in data:
+            return str(data[f]) if data[f] else None
+    return None
+def find_ticket_room(ticket_id):
+    for rid, tickets in list(USER_TICKET_MAP.items()):
+        if ticket_id in tickets:
+            return rid
+    return None
+def parse_halo_event(data):
+    # --- GEREDUCEERDE LOGGING VAN WEBHOOK DATA ---
     # Log alleen relevante velden in plaats van volledige JSON
     relevant_data = {
         "ticket_id": data.get("ticket_id") or data.get("TicketId") or data.get("TicketNumber"),
@@ -526,12 +1317,7 @@ def halo_action():
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
     }
     log.info(f"📥 HALO WEBHOOK DATA: {json.dumps(relevant_data, indent=2)}")
-    # Controleer alle mogelijke veldnamen voor ticket ID
-    ticket_id = None
-    for f in ["ticket_id", "TicketId", "TicketID", "TicketNumber", "id", "Ticket_Id", "ticketnumber", "Ticket_ID", "ticketid", "TicketID", "TicketID", "ticket_id", "TicketID"]:
-        if f in data:
-            ticket_id = data[f]
-            break
+    ticket_id = halo_event_ticket_id(data)
     # Controleer alle mogelijke veldnamen voor notitietekst
     note_text = None
     for f in ["outcome", "note", "text", "comment", "description", "public_note", "note_text", "comment_text", "action_description", "notecontent", "NoteContent", "note_body", "NoteBody", "note_text", "NoteText", "action_note", "ActionNote"]:
@@ -556,21 +1342,6 @@ def halo_action():
         if f in data:
             action_id = data[f]
             break
-    # Als we geen ticket_id hebben, log dit en stopt
-    if not ticket_id:
-        log.warning("❌ Geen ticket_id gevonden in webhook data")
-        return {"status": "ignore"}
-    # Zorg dat ticket_id een string is voor consistentie
-    ticket_id = str(ticket_id)
-    # Zoek de room waar dit ticket in zit
-    room_id = None
-    for rid, tickets in USER_TICKET_MAP.items():
-        if ticket_id in tickets:
-            room_id = rid
-            break
-    if not room_id:
-        log.warning(f"❌ Geen Webex-room gevonden voor ticket {ticket_id}")
-        return {"status": "ignore"}
     # Achterhaal auteur / agent naam (voor notities en assignments)
     note_author = None
     for f in ["note_author", "author", "created_by", "CreatedBy", "user", "User", "username", "Username", "agent", "Agent", "action_user", "ActionUser", "entered_by", "EnteredBy"]:
@@ -582,38 +1353,72 @@ def halo_action():
     last_name = data.get("last_name") or data.get("LastName") or data.get("lastname")
     if (first_name or last_name) and not note_author:
         note_author = f"{first_name or ''} {last_name or ''}".strip()
+    # Soort event bepalen in dezelfde volgorde als de verwerking: note > status > assignment
+    if note_text and str(note_text).strip():
+        kind = "note"
+    elif status_change:
+        kind = "status"
+    elif assigned_agent:
+        kind = "assignment"
+    else:
+        kind = None
+    return {
+        "ticket_id": ticket_id,
+        "kind": kind,
+        "note_text": note_text,
+        "status_change": status_change,
+        "assigned_agent": assigned_agent,
+        "action_id": action_id,
+        "note_author": note_author,
+        "first_name": first_name,
+        "last_name": last_name
+    }
+def is_duplicate_event(kind, ticket_id, content):
+    # Dedupe helper (best effort binnen single process)
+    key_hash = hash(f"{kind}:{ticket_id}:{content.strip()}")
+    now = time.time()
+    ts = LAST_WEBHOOK_EVENTS.get(key_hash)
+    if ts and now - ts < DEDUPE_SECONDS:
+        return True
+    LAST_WEBHOOK_EVENTS[key_hash] = now
+    for k, v in list(LAST_WEBHOOK_EVENTS.items()):
+        if now - v > DEDUPE_SECONDS * 2:
+            del LAST_WEBHOOK_EVENTS[k]
+    return False
+def handle_halo_event(ev):
+    # Verwerkt één geparsed event; geeft (resultaat, room_id, bericht) terug.
+    # Het versturen van het bericht laat de aanroeper doen, zodat batches per room gebundeld kunnen worden.
+    ticket_id = ev["ticket_id"]
+    # Als we geen ticket_id hebben, log dit en stopt
+    if not ticket_id:
+        log.warning("❌ Geen ticket_id gevonden in webhook data")
+        return "ignore", None, None
+    # Zoek de room waar dit ticket in zit
+    room_id = find_ticket_room(ticket_id)
+    if not room_id:
+        log.warning(f"❌ Geen Webex-room gevonden voor ticket {ticket_id}")
+        return "ignore", None, None
+    maybe_evict_tickets()
     # Tracker initialiseren indien onbekend
     if ticket_id not in TICKET_STATUS_TRACKER:
         TICKET_STATUS_TRACKER[ticket_id] = {"status": None, "assignee": None, "last_checked": time.time()}
-    # Dedupe helper (best effort binnen single process)
-    def is_duplicate(kind: str, content: str):
-        key_hash = hash(f"{kind}:{ticket_id}:{content.strip()}")
-        now = time.time()
-        ts = LAST_WEBHOOK_EVENTS.get(key_hash)
-        if ts and now - ts < DEDUPE_SECONDS:
-            return True
-        LAST_WEBHOOK_EVENTS[key_hash] = now
-        for k, v in list(LAST_WEBHOOK_EVENTS.items()):
-            if now - v > DEDUPE_SECONDS * 2:
-                del LAST_WEBHOOK_EVENTS[k]
-        return False
     # Public / agent note detection: stuur bij elke note_text tenzij leeg.
     # We beperken duplicates; actie_id hoeft niet exact te matchen.
-    if note_text and str(note_text).strip():
-        if is_duplicate("note", note_text):
+    if ev["kind"] == "note":
+        note_text = ev["note_text"]
+        if is_duplicate_event("note", ticket_id, str(note_text)):
             log.info(f"🔁 Duplicate note genegeerd voor ticket {ticket_id}")
-            return {"status": "duplicate"}
+            return "duplicate", room_id, None
         log.info(f"✅ Note ontvangen voor ticket {ticket_id}")
-        author_segment = f" door {note_author}" if note_author else ""
-        send_message(room_id, f"📥 **Public note{author_segment}**\n{note_text}")
-        return {"status": "ok"}
+        author_segment = f" door {ev['note_author']}" if ev["note_author"] else ""
+        return "ok", room_id, f"📥 **Public note{author_segment}**\n{note_text}"
     # Verwerk statuswijzigingen (converteer ID naar naam)
-    if status_change:
+    if ev["kind"] == "status":
+        status_change = ev["status_change"]
         # Converteer status ID naar naam als nodig
         if isinstance(status_change, int) or (isinstance(status_change, str) and status_change.isdigit()):
             status_name = get_status_name(status_change)
             log.info(f"✅ Status ID {status_change} geconverteerd naar naam: {status_name}")
-            status_change = status_name
         else:
             status_name = status_change
         # Filter via whitelist (indien ingesteld). Alleen versturen als whitelist leeg OF status in whitelist.
@@ -622,34 +1427,78 @@ def halo_action():
             log.info(f"🔁 Status '{status_name}' al bekend voor ticket {ticket_id}; geen bericht")
         elif STATUS_NOTIFY_WHITELIST and status_name.lower() not in STATUS_NOTIFY_WHITELIST:
             log.info(f"🔕 Webhook status '{status_name}' genegeerd (niet in whitelist)")
-            TICKET_STATUS_TRACKER[ticket_id]["status"] = status_name  # Update zonder notificatie
+            set_ticket_status(ticket_id, status_name)  # Update zonder notificatie
         else:
-            if is_duplicate("status", status_name):
+            if is_duplicate_event("status", ticket_id, status_name):
                 log.info(f"🔁 Duplicate status event genegeerd voor ticket {ticket_id}: {status_name}")
-                return {"status": "duplicate"}
+                return "duplicate", room_id, None
             log.info(f"✅ Statuswijziging ontvangen voor ticket {ticket_id}: {status_name}")
-            send_message(room_id, f"⚠️ Ticket #{ticket_id} status gewijzigd naar: **{status_name}**")
-            TICKET_STATUS_TRACKER[ticket_id]["status"] = status_name
-        return {"status": "ok"}
+            set_ticket_status(ticket_id, status_name)
+            return "ok", room_id, f"⚠️ Ticket #{ticket_id} status gewijzigd naar: **{status_name}**"
+        return "ok", room_id, None
     # Verwerk toewijzingen
-    if assigned_agent:
+    if ev["kind"] == "assignment":
+        assigned_agent = ev["assigned_agent"]
         assignee_display = assigned_agent
-        if (first_name or last_name) and not assigned_agent:
-            assignee_display = f"{first_name or ''} {last_name or ''}".strip()
+        if (ev["first_name"] or ev["last_name"]) and not assigned_agent:
+            assignee_display = f"{ev['first_name'] or ''} {ev['last_name'] or ''}".strip()
         prev_assignee = TICKET_STATUS_TRACKER[ticket_id].get("assignee")
         if prev_assignee == assignee_display:
             log.info(f"🔁 Assignee '{assignee_display}' al bekend voor ticket {ticket_id}; geen bericht")
         else:
-            if is_duplicate("assignment", assignee_display):
+            if is_duplicate_event("assignment", ticket_id, str(assignee_display)):
                 log.info(f"🔁 Duplicate assignment genegeerd voor ticket {ticket_id}")
-                return {"status": "duplicate"}
+                return "duplicate", room_id, None
             log.info(f"✅ Toewijzing ontvangen voor ticket {ticket_id}: {assignee_display}")
-            send_message(room_id, f"✅ Ticket #{ticket_id} geassigned naar **{assignee_display}**")
             TICKET_STATUS_TRACKER[ticket_id]["assignee"] = assignee_display
-        return {"status": "ok"}
+            return "ok", room_id, f"✅ Ticket #{ticket_id} geassigned naar **{assignee_display}**"
+        return "ok", room_id, None
     # Als geen van de bovenstaande gevalen, log en stopt
     log.warning("❌ Geen herkenbare actie in webhook data")
-    return {"status": "ignore"}
+    return "ignore", room_id, None
+def process_halo_batch(events):
+    # Eén pass over de batch: per ticket telt alleen de laatste status en de laatste assignment,
+    # notes worden allemaal verwerkt. Berichten worden per room gebundeld verstuurd.
+    results = [None] * len(events)
+    parsed = []
+    for i, data in enumerate(events):
+        if not isinstance(data, dict):
+            results[i] = {"index": i, "ticket_id": None, "status": "invalid"}
+            continue
+        parsed.append((i, parse_halo_event(data)))
+    latest = {}
+    for i, ev in parsed:
+        if ev["ticket_id"] and ev["kind"] in ("status", "assignment"):
+            latest[(ev["ticket_id"], ev["kind"])] = i
+    room_messages = {}
+    for i, ev in parsed:
+        # Zonder ticket_id is er niets te vervangen; handle_halo_event geeft dan "ignore"
+        if ev["ticket_id"] and ev["kind"] in ("status", "assignment") and latest.get((ev["ticket_id"], ev["kind"])) != i:
+            results[i] = {"index": i, "ticket_id": ev["ticket_id"], "status": "superseded"}
+            continue
+        try:
+            result, room_id, message = handle_halo_event(ev)
+        except Exception as e:
+            log.error(f"💥 Fout bij verwerken batch event {i} (ticket {ev['ticket_id']}): {e}")
+            result, room_id, message = "error", None, None
+        if message:
+            room_messages.setdefault(room_id, []).append(message)
+        results[i] = {"index": i, "ticket_id": ev["ticket_id"], "status": result}
+    for room_id, messages in room_messages.items():
+        for chunk in chunk_messages(messages):
+            send_message(room_id, chunk)
+    log.info(f"✅ Halo batch verwerkt: {len(events)} events, {len(room_messages)} rooms genotificeerd")
+    return {"status": "ok", "count": len(events), "results": results}
+def chunk_messages(messages, max_len=6000):
+    # Webex berichten hebben een maximale lengte; bundel zo veel mogelijk per bericht
+    chunk = ""
+    for m in messages:
+        if chunk and len(chunk) + len(m) + 2 > max_len:
+            yield chunk
+            chunk = ""
+        chunk = f"{chunk}\n\n{m}" if chunk else m
+    if chunk:
+        yield chunk
 # --------------------------------------------------------------------------
 # KB LEEMMAK FUNCTIE
 # --------------------------------------------------------------------------
@@ -725,20 +1574,22 @@ def empty_knowledge_base():
             break
 
         page_no += 1
-        time.sleep(0.2)
+        cooperative_sleep(0.2)
 
     log.info(f"🔍 Totaal {len(all_ids)} artikelen gevonden — start verwijderen")
 
-    deleted_count = 0
-    for i, article_id in enumerate(all_ids, start=1):
+    def delete_article(article_id):
         del_url = f"{HALO_API_BASE}/api/KBArticle/{article_id}"
-        log.info(f"🗑️ ({i}/{len(all_ids)}) Verwijderen artikel {article_id}")
+        log.info(f"🗑️ Verwijderen artikel {article_id}")
         r = halo_request(del_url, method="DELETE", headers=h)
         if r.status_code in (200, 204):
-            deleted_count += 1
             log.info(f"✅ Artikel {article_id} verwijderd")
-        else:
-            log.error(f"❌ Fout bij verwijderen KB artikel {article_id}: {r.status_code} - {r.text[:300]}")
+            return True
+        log.error(f"❌ Fout bij verwijderen KB artikel {article_id}: {r.status_code} - {r.text[:300]}")
+        return False
+
+    # Parallel (begrensd) verwijderen; halo_request handelt 429's zelf af
+    deleted_count = sum(run_parallel(delete_article, all_ids, KB_DELETE_CONCURRENCY))
 
     log.info(f"✅ Verwijderd: {deleted_count}/{len(all_ids)} KB artikelen")
     return deleted_count
@@ -750,8 +1601,16 @@ def webex_hook():
     if not WEBEX_HEADERS:
         log.error("❌ WEBEX_HEADERS is niet ingesteld")
         return {"status": "ignore"}
-    threading.Thread(target=process_webex_event, args=(request.json,)).start()
+    record_webhook("/webex", request.json)
+    spawn_worker(run_webex_event, request.json)
+    maybe_replay_retry_queue()
     return {"status": "ok"}
+def run_webex_event(payload):
+    with traced("job:webex_event", resource=(payload or {}).get("resource")):
+        try:
+            process_webex_event(payload)
+        except CircuitOpenError as e:
+            log.warning(f"⏸️ Webex event niet verwerkt: {e}")
 @app.route("/initialize", methods=["GET"])
 def initialize():
     if not WEBEX_HEADERS:
@@ -760,7 +1619,7 @@ def initialize():
     get_users()
     # Start poller alleen als expliciet aangezet
     if POLL_STATUS_ENABLED:
-        threading.Thread(target=status_check_loop, daemon=True).start()
+        spawn_background(status_check_loop)
     return {
         "status": "initialized",
         "source": f"client{HALO_CLIENT_ID_NUM}_site{HALO_SITE_ID}",
@@ -771,10 +1630,68 @@ def health():
     return {
         "status": "ok",
         "tickets_tracked": len(TICKET_STATUS_TRACKER),
-        "rooms": len(USER_TICKET_MAP)
+        "rooms": len(USER_TICKET_MAP),
+        "memory": memory_footprint(),
+        "circuits": {name: c["state"] for name, c in CIRCUITS.items()},
+        "retry_queue": len(RETRY_QUEUE),
+        "concurrency": CONCURRENCY
     }
+@app.route("/debug/traces", methods=["GET"])
+def debug_traces():
+    # Traagste recente traces eerst; ?limit=N beperkt het aantal
+    limit = request.args.get("limit", default=20, type=int)
+    with TRACE_LOCK:
+        _prune_trace_buffer(time.time())
+        traces = [item[2] for item in sorted(TRACE_BUFFER, reverse=True)]
+    return {
+        "slow_threshold_ms": TRACE_SLOW_MS,
+        "max_age_s": TRACE_MAX_AGE_SECONDS,
+        "buffered": len(traces),
+        "traces": traces[:limit]
+    }
+@app.route("/debug/commands", methods=["GET"])
+def debug_commands():
+    with COMMAND_STATS_LOCK:
+        return {name: {"count": st["count"],
+                       "avg_ms": round(st["total_ms"] / st["count"], 1),
+                       "max_ms": round(st["max_ms"], 1)}
+                for name, st in COMMAND_STATS.items()}
+@app.route("/debug/seed", methods=["POST"])
+def debug_seed():
+    # Alleen voor load tests: replay.py laadt hiermee de opgenomen ticket → room koppeling,
+    # zodat afgespeelde /halo-action events een room vinden. Uit tenzij REPLAY_SEED_ENABLED.
+    if not REPLAY_SEED_ENABLED:
+        return {"error": "seed_disabled"}, 404
+    rooms = (request.get_json(silent=True) or {}).get("rooms") or {}
+    seeded = 0
+    for tid, room_id in rooms.items():
+        tid = str(tid)
+        if not room_id or find_ticket_room(tid):
+            continue
+        USER_TICKET_MAP.setdefault(room_id, []).append(tid)
+        TICKET_STATUS_TRACKER.setdefault(tid, {"status": None, "assignee": None, "last_checked": time.time()})
+        seeded += 1
+    maybe_evict_tickets()
+    log.info(f"🌱 {seeded} tickets gekoppeld aan rooms voor replay")
+    return {"status": "ok", "seeded": seeded}
 @app.route("/tickets/<room_id>", methods=["GET"])
 def list_room_tickets(room_id):
+    # ?refresh=1 haalt actuele status/assignee op met één bulk query (gepagineerd via page/page_size)
+    if request.args.get("refresh") in ["1", "true", "True"]:
+        page = max(1, request.args.get("page", default=1, type=int))
+        page_size = max(1, min(100, request.args.get("page_size", default=ROOM_TICKETS_PAGE_SIZE, type=int)))
+        try:
+            rows, total = refresh_room_tickets(room_id, page, page_size)
+        except (CircuitOpenError, requests.RequestException) as e:
+            # Halo onbereikbaar: gecachte rijen teruggeven met 503
+            log.error(f"❌ Tickets verversen voor room {room_id} mislukt: {e}")
+            page_ids, total = room_ticket_page(room_id, page, page_size)
+            rows = [{"ticket_id": tid,
+                     "status": TICKET_STATUS_TRACKER.get(tid, {}).get("status"),
+                     "assignee": TICKET_STATUS_TRACKER.get(tid, {}).get("assignee")} for tid in page_ids]
+            return {"tickets": rows, "page": page, "page_size": page_size, "total": total,
+                    "error": "halo_unavailable", "cached": True}, 503
+        return {"tickets": rows, "page": page, "page_size": page_size, "total": total}
     tickets = USER_TICKET_MAP.get(room_id, [])
     result = []
     for tid in tickets:
@@ -808,11 +1725,14 @@ def ticket_details(ticket_id):
 def status_check_loop():
     while True:
         try:
-            check_ticket_status_changes()
-            time.sleep(60)
+            with traced("job:status_check", tickets=len(TICKET_STATUS_TRACKER)):
+                check_ticket_status_changes()
+                maybe_evict_tickets()
+            maybe_replay_retry_queue()
+            cooperative_sleep(60)
         except Exception as e:
             log.error(f"💥 Fout bij status check loop: {e}")
-            time.sleep(60)
+            cooperative_sleep(60)
 # --------------------------------------------------------------------------
 # START
 # --------------------------------------------------------------------------
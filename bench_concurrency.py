@@ -0,0 +1,128 @@
+"""Benchmark: coöperatieve (gevent) modus vs. threads modus.
+
+Start een gevent stub-upstream met vaste latency en vuurt in een apart proces per modus
+N gelijktijdige halo_request calls af via spawn_worker, precies zoals webhook jobs lopen.
+Per modus wordt de doorlooptijd, throughput, het piekaantal OS threads en het max RSS gemeten.
+
+Voorbeeld:
+    python bench_concurrency.py --calls 2000 --latency-ms 200
+    python bench_concurrency.py --modes gevent --calls 5000
+"""
+import argparse, json, os, subprocess, sys, tempfile, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_stub(port, latency_ms):
+    from gevent import monkey
+    monkey.patch_all()
+    import gevent
+    from gevent.pywsgi import WSGIServer
+
+    def app(environ, start_response):
+        gevent.sleep(latency_ms / 1000)
+        if environ["PATH_INFO"] == "/auth/token":
+            body = {"access_token": "bench", "expires_in": 3600}
+        else:
+            body = {"id": 1, "Status": "Open"}
+        start_response("200 OK", [("Content-Type", "application/json")])
+        return [json.dumps(body).encode()]
+
+    WSGIServer(("127.0.0.1", port), app, log=None, spawn=10000).serve_forever()
+
+
+def os_thread_count():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import threading
+    return threading.active_count()
+
+
+def run_child(mode, port, calls):
+    # Omgeving voor app.py: dummy credentials, upstreams naar de stub, pool groot genoeg voor alle calls
+    os.environ.update({
+        "CONCURRENCY_MODE": mode,
+        "WORKER_POOL_SIZE": str(calls),
+        "HALO_AUTH_URL": f"http://127.0.0.1:{port}/auth/token",
+        "HALO_API_BASE": f"http://127.0.0.1:{port}",
+        "HALO_CLIENT_ID": "bench", "HALO_CLIENT_SECRET": "bench",
+        "WEBEX_BOT_TOKEN": "bench", "AUTHORIZED_USERS": "bench@example.com",
+        "RETRY_QUEUE_PATH": os.path.join(tempfile.gettempdir(), "bench_retry_queue.json"),
+    })
+    sys.path.insert(0, HERE)
+    import logging
+    import app
+    logging.getLogger("halo-api").setLevel(logging.WARNING)
+
+    done = []
+    peak_threads = [os_thread_count()]
+
+    def job(i):
+        r = app.halo_request(f"{app.HALO_API_BASE}/api/Tickets/{i}")
+        done.append(r.status_code)
+        if i % 50 == 0:
+            peak_threads[0] = max(peak_threads[0], os_thread_count())
+
+    start = time.perf_counter()
+    for i in range(calls):
+        app.spawn_worker(job, i)
+    peak_threads[0] = max(peak_threads[0], os_thread_count())
+    while len(done) < calls:
+        app.cooperative_sleep(0.01)
+        peak_threads[0] = max(peak_threads[0], os_thread_count())
+    wall = time.perf_counter() - start
+
+    import resource
+    print(json.dumps({
+        "mode": app.CONCURRENCY,
+        "calls": calls,
+        "ok": sum(1 for s in done if s == 200),
+        "wall_s": round(wall, 2),
+        "calls_per_s": round(calls / wall, 1),
+        "peak_os_threads": peak_threads[0],
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vergelijk gevent en threads modus van app.py")
+    parser.add_argument("--calls", type=int, default=2000, help="aantal gelijktijdige upstream calls")
+    parser.add_argument("--latency-ms", type=int, default=200, help="latency van de stub upstream")
+    parser.add_argument("--port", type=int, default=8097)
+    parser.add_argument("--modes", default="threads,gevent")
+    parser.add_argument("--_child", help=argparse.SUPPRESS)
+    parser.add_argument("--_stub", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args._stub:
+        return run_stub(args.port, args.latency_ms)
+    if args._child:
+        return run_child(args._child, args.port, args.calls)
+
+    stub = subprocess.Popen([sys.executable, __file__, "--_stub", "--port", str(args.port),
+                             "--latency-ms", str(args.latency_ms)])
+    try:
+        time.sleep(1)
+        print(f"⏱️ {args.calls} gelijktijdige upstream calls, stub latency {args.latency_ms}ms")
+        print(f"   {'modus':<9}{'ok':>7}{'tijd (s)':>10}{'calls/s':>10}{'OS threads':>12}{'RSS (MB)':>10}")
+        for mode in args.modes.split(","):
+            out = subprocess.run([sys.executable, __file__, "--_child", mode, "--port", str(args.port),
+                                  "--calls", str(args.calls)], capture_output=True, text=True)
+            lines = [l for l in out.stdout.splitlines() if l.startswith("{")]
+            if out.returncode != 0 or not lines:
+                print(f"   {mode:<9} mislukt: {out.stderr.strip().splitlines()[-1:]}")
+                continue
+            r = json.loads(lines[-1])
+            print(f"   {r['mode']:<9}{r['ok']:>7}{r['wall_s']:>10}{r['calls_per_s']:>10}"
+                  f"{r['peak_os_threads']:>12}{r['max_rss_mb']:>10}")
+    finally:
+        stub.terminate()
+
+
+if __name__ == "__main__":
+    main()
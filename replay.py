@@ -0,0 +1,257 @@
+"""Webhook replay tool voor load tests.
+
+Speelt met RECORD_WEBHOOKS_PATH opgenomen /webex en /halo-action payloads opnieuw af
+tegen een lokale instance, en kan zelf stub-upstreams (Halo + Webex) draaien zodat
+er niets naar productie gaat.
+
+Voorbeeld:
+    # 1. Stub upstreams (Halo auth/API en Webex op één poort)
+    python replay.py stub --port 8099 --latency-ms 80
+
+    # 2. App lokaal tegen de stubs (gunicorn zoals in de Dockerfile)
+    HALO_AUTH_URL=http://127.0.0.1:8099/auth/token HALO_API_BASE=http://127.0.0.1:8099 \\
+    WEBEX_API_BASE=http://127.0.0.1:8099/webex REPLAY_SEED_ENABLED=1 \\
+    gunicorn app:app -w 1 -k gevent -b 127.0.0.1:5000
+
+    # 3. Replay op 1x, 10x of maximale snelheid
+    python replay.py replay webhooks.jsonl --target http://127.0.0.1:5000 --speed 10
+    python replay.py replay webhooks.jsonl --speed max --concurrency 200
+
+Voor het afspelen wordt de ticket → room koppeling uit de opname (veld "rooms" van /halo-action
+regels) via /debug/seed in de app geladen, zodat de events een Webex-room vinden zoals in productie.
+Zonder REPLAY_SEED_ENABLED=1 op de app (of bij een opname zonder "rooms") eindigen /halo-action
+events in "Geen Webex-room gevonden" en meet de replay alleen de ack en het parsen; het rapport meldt dat.
+
+Let op: /webex antwoordt direct en verwerkt het event op de achtergrond. De latency in
+het rapport is dus de ack-tijd; de doorlooptijd van het achtergrondwerk staat in /debug/traces.
+"""
+import argparse, json, re, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import requests
+
+
+# --------------------------------------------------------------------------
+# STUB UPSTREAMS
+# --------------------------------------------------------------------------
+def make_stub_handler(latency_ms):
+    ticket_counter = {"next": 100000}
+    counter_lock = threading.Lock()
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def _reply(self, body, status=200):
+            if latency_ms:
+                time.sleep(latency_ms / 1000)
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _drain(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if m := re.match(r"^/webex/messages/(.+)$", path):
+                self._reply({"id": m.group(1), "roomId": "stub-room", "personEmail": "replay@example.com",
+                             "text": "replay bericht"})
+            elif path.startswith("/webex/attachment/actions/"):
+                self._reply({"inputs": {"email": "replay@example.com", "omschrijving": "replay"}})
+            elif m := re.match(r"^/api/Tickets/(\d+)$", path):
+                self._reply({"id": int(m.group(1)), "Status": "Open"})
+            elif path == "/api/Tickets":
+                ids = re.findall(r"\d+", parse_qs(urlparse(self.path).query).get("ticketids", [""])[0])
+                self._reply({"record_count": len(ids),
+                             "tickets": [{"id": int(t), "summary": "replay", "status_id": 2} for t in ids]})
+            elif m := re.match(r"^/api/Status/(\d+)$", path):
+                self._reply({"id": int(m.group(1)), "name": f"Status {m.group(1)}"})
+            elif path in ("/api/Users", "/api/KBArticle"):
+                self._reply([])
+            else:
+                self._reply({"error": "not_found"}, 404)
+
+        def do_POST(self):
+            self._drain()
+            path = self.path.split("?")[0]
+            if path == "/auth/token":
+                self._reply({"access_token": "stub", "expires_in": 3600})
+            elif path == "/api/Tickets":
+                with counter_lock:
+                    ticket_counter["next"] += 1
+                    tid = ticket_counter["next"]
+                self._reply([{"id": tid, "Status": "New"}], 201)
+            elif path == "/api/Actions":
+                self._reply([{"id": 1}], 201)
+            elif path == "/webex/messages":
+                self._reply({"id": "stub-message"})
+            else:
+                self._reply({"error": "not_found"}, 404)
+
+        def do_DELETE(self):
+            self._drain()
+            self._reply({}, 200)
+
+    return StubHandler
+
+
+def run_stub(args):
+    server = ThreadingHTTPServer((args.host, args.port), make_stub_handler(args.latency_ms))
+    server.daemon_threads = True
+    print(f"🧪 Stub upstreams op http://{args.host}:{args.port} (latency {args.latency_ms}ms)")
+    print(f"   HALO_AUTH_URL=http://{args.host}:{args.port}/auth/token")
+    print(f"   HALO_API_BASE=http://{args.host}:{args.port}")
+    print(f"   WEBEX_API_BASE=http://{args.host}:{args.port}/webex")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+# --------------------------------------------------------------------------
+# REPLAY
+# --------------------------------------------------------------------------
+def load_recording(path):
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    entries.sort(key=lambda e: e["ts"])
+    return entries
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[idx]
+
+
+def send_entry(session, target, entry, halo_auth):
+    url = target + entry["path"]
+    auth = halo_auth if entry["path"] == "/halo-action" else None
+    t0 = time.perf_counter()
+    try:
+        if entry.get("ct") == "form":
+            r = session.post(url, data=entry["body"], auth=auth, timeout=30)
+        else:
+            r = session.post(url, json=entry["body"], auth=auth, timeout=30)
+        status = r.status_code
+    except requests.RequestException as e:
+        status = type(e).__name__
+    return entry["path"], status, (time.perf_counter() - t0) * 1000
+
+
+def seed_rooms(session, target, entries):
+    # Verzamelt de opgenomen ticket → room koppeling en laadt die in de app; geeft een waarschuwing terug of None
+    rooms = {}
+    for entry in entries:
+        rooms.update(entry.get("rooms") or {})
+    if not rooms:
+        if any(e["path"] == "/halo-action" for e in entries):
+            return "opname bevat geen ticket → room koppeling; /halo-action events vinden geen room"
+        return None
+    try:
+        r = session.post(target + "/debug/seed", json={"rooms": rooms}, timeout=30)
+    except requests.RequestException as e:
+        return f"seeden mislukt ({type(e).__name__}); /halo-action events vinden geen room"
+    if r.status_code != 200:
+        return f"seeden mislukt ({r.status_code}, zet REPLAY_SEED_ENABLED=1 op de app); /halo-action events vinden geen room"
+    print(f"🌱 {r.json().get('seeded', 0)} van {len(rooms)} opgenomen tickets aan rooms gekoppeld")
+    return None
+
+
+def run_replay(args):
+    entries = load_recording(args.file)
+    if not entries:
+        print("❌ Geen events in opname")
+        return 1
+    speed = None if args.speed == "max" else float(args.speed)
+    halo_auth = tuple(args.halo_auth.split(":", 1))
+    t_first = entries[0]["ts"]
+    span = entries[-1]["ts"] - t_first
+    print(f"▶️ Replay {len(entries)} events ({span:.1f}s opgenomen) naar {args.target} op "
+          f"{'max' if speed is None else f'{speed:g}x'} snelheid, concurrency {args.concurrency}")
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=args.concurrency, pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    seed_warning = seed_rooms(session, args.target, entries)
+    if seed_warning:
+        print(f"⚠️ {seed_warning}")
+    futures = []
+    max_lag_ms = 0.0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for entry in entries:
+            if speed is not None:
+                due = (entry["ts"] - t_first) / speed
+                delay = due - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    max_lag_ms = max(max_lag_ms, -delay * 1000)
+            futures.append(pool.submit(send_entry, session, args.target, entry, halo_auth))
+        results = [f.result() for f in futures]
+    wall = time.perf_counter() - start
+
+    print_report(results, wall, max_lag_ms, seed_warning)
+    return 0
+
+
+def print_report(results, wall, max_lag_ms, seed_warning=None):
+    latencies = [ms for _, _, ms in results]
+    statuses = {}
+    per_path = {}
+    for path, status, ms in results:
+        statuses[status] = statuses.get(status, 0) + 1
+        per_path.setdefault(path, []).append(ms)
+    print()
+    print(f"📊 {len(results)} requests in {wall:.2f}s → {len(results) / wall:.1f} req/s")
+    print(f"   Max schema-achterstand client: {max_lag_ms:.0f}ms")
+    print(f"   Status codes: {json.dumps({str(k): v for k, v in sorted(statuses.items(), key=str)})}")
+    rows = [("ALLE", latencies)] + sorted(per_path.items())
+    print(f"   {'pad':<14}{'n':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}  (ms)")
+    for name, values in rows:
+        print(f"   {name:<14}{len(values):>7}{percentile(values, 50):>9.1f}{percentile(values, 90):>9.1f}"
+              f"{percentile(values, 99):>9.1f}{max(values):>9.1f}")
+    if seed_warning:
+        print(f"   ⚠️ Geen room-seeding: {seed_warning}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay opgenomen webhooks tegen een lokale instance")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_stub = sub.add_parser("stub", help="draai stub Halo/Webex upstreams")
+    p_stub.add_argument("--host", default="127.0.0.1")
+    p_stub.add_argument("--port", type=int, default=8099)
+    p_stub.add_argument("--latency-ms", type=int, default=0, help="kunstmatige vertraging per upstream call")
+    p_stub.set_defaults(func=run_stub)
+
+    p_replay = sub.add_parser("replay", help="speel een opname (RECORD_WEBHOOKS_PATH) af")
+    p_replay.add_argument("file")
+    p_replay.add_argument("--target", default="http://127.0.0.1:5000")
+    p_replay.add_argument("--speed", default="1", help="1, N (bv. 10) of 'max'")
+    p_replay.add_argument("--concurrency", type=int, default=50)
+    p_replay.add_argument("--halo-auth", default="Webexbot:Webexbot2025", help="basic auth voor /halo-action")
+    p_replay.set_defaults(func=run_replay)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())